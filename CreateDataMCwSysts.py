@@ -1,10 +1,16 @@
 import ROOT
 from ROOT import gDirectory, gStyle, gPad, TColor, gROOT
 import os
+import sys
 import argparse
 import re
+import glob
 import json
+import csv
+import hashlib
+import inspect
 from math import sqrt, log10, floor, pow
+import numpy
 import logging
 logging.basicConfig(level=logging.INFO)
 
@@ -16,6 +22,11 @@ logging.basicConfig(level=logging.INFO)
 def main():
 	args = get_args()
 
+	if args.Compare:
+		# Regression check between two outputs, nothing else needs to run
+		FilesMatch = CompareFiles(args)
+		sys.exit(0 if FilesMatch else 1)
+
 	# TDirectory channels you want to run over
 	TDirNames = ["emu_OS_J2"]
 
@@ -31,6 +42,23 @@ def main():
 	SystSamples = Samples["SystSamples"]
 	DataSamples = Samples["DataSamples"]
 
+	if args.CreateInputs:
+		# Fill the _combination.root inputs from the ntuples before anything else runs
+		CreateInputFiles(args, TDirNames, Plots, NomSamples, SystSamples, DataSamples)
+
+	if args.CreateFile or args.BuildCatalog:
+		# Index of the input files so they are only opened when they changed
+		Catalog = OpenCatalog(args, NomSamples + SystSamples + DataSamples)
+
+	if args.CreateFile:
+		# Journal of completed units so a killed run can be picked up with --Resume
+		Journal = OpenJournal(args)
+		# Thresholds and report for dropping negligible or duplicated systematics
+		Pruning = OpenPruning(args)
+	# Per channel tables filled by the numbers only export and the systematic breakdown
+	Numbers = {}
+	Breakdowns = {}
+
 	EventVar = False
 	for Type, TypeDict in Plots.items():
 		logging.info("Running code over " + Type + " ... ")
@@ -44,9 +72,17 @@ def main():
 
 		logging.debug("Looping over:\t" + str(Objs) + "\t and:\t" + str(Vars))
 		if args.CreateFile:
-			CreateSystFile(args, TDirNames, Objs, Vars, NomSamples, SystSamples, DataSamples, EventVar)
+			CreateSystFile(args, TDirNames, Objs, Vars, NomSamples, SystSamples, DataSamples, EventVar, Journal, Pruning, Catalog)
 		elif args.PlotFile:
 			FilePlotter(args, TDirNames, Objs, Vars, NomSamples, SystSamples, DataSamples, EventVar)
+		if args.ExportNumbers:
+			NumbersExporter(args, TDirNames, Objs, Vars, NomSamples, SystSamples, DataSamples, EventVar, Numbers)
+		if args.Breakdown:
+			SystematicBreakdown(args, TDirNames, Objs, Vars, NomSamples, SystSamples, EventVar, Breakdowns)
+	if args.ExportNumbers:
+		WriteNumbers(args, Numbers, NomSamples)
+	if args.Breakdown:
+		WriteBreakdowns(args, Breakdowns)
 	logging.info("Finished")
 
 def FilePlotter(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystSamples, DataSamples, EventVar):
@@ -70,6 +106,12 @@ def FilePlotter(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystS
 		if not os.path.exists(cwd):
 			os.makedirs(cwd)
 
+		# Fingerprints of the plots already rendered into this directory
+		RenderCachePath = cwd + "RenderCache.json"
+		RenderCache = {}
+		if os.path.exists(RenderCachePath) and not Args.NoRenderCache:
+			RenderCache = byteify(json.load(file(RenderCachePath)))
+
 		for Obj in Objects:
 			for Var in Variables:
 				logging.info("------------------------------------------------------------")
@@ -84,6 +126,15 @@ def FilePlotter(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystS
 				NominalHists = GetNominalContributions(PlotFile, TDirectoryName, NameCheck, NominalSamples)
 				logging.debug(NominalHists)
 
+				PlotSuffix = ""
+				if Args.StackByFlavour:
+					FlavourHists = GetFlavourContributions(PlotFile, TDirectoryName, NameCheck, NominalSamples)
+					if len(FlavourHists) != 0:
+						NominalHists = FlavourHists
+						PlotSuffix = "_Flavour"
+					else:
+						logging.info("No flavour components stored for " + NameCheck + ", stacking by process instead")
+
 				DataHists = GetDataContributions(PlotFile, TDirectoryName, NameCheck, DataSamples)
 				logging.debug(DataHists)
 
@@ -91,12 +142,333 @@ def FilePlotter(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystS
 				logging.debug(SystBand)
 
 				if not Args.NoBatch:
-					ExportPlot(TDirectoryName, NominalHists, DataHists, SystBand, True)
+					# Only redraw plots whose inputs or style have changed since the last run
+					PlotName = GetPlotName(DataHists[0], PlotSuffix)
+					Fingerprint = GetPlotFingerprint(NominalHists, DataHists, SystBand, PlotSuffix, Args.PlotFormat)
+					if RenderCache.get(PlotName) == Fingerprint and os.path.exists(cwd + PlotName + "." + Args.PlotFormat):
+						logging.info("Plot unchanged, skipping:\t" + PlotName)
+						continue
+					ExportPlot(TDirectoryName, NominalHists, DataHists, SystBand, True, PlotSuffix, cwd, Args.PlotFormat)
+					RenderCache[PlotName] = Fingerprint
+					WriteJsonAtomic(RenderCachePath, RenderCache)
 				else:
-					ExportPlot(TDirectoryName, NominalHists, DataHists, SystBand)
+					ExportPlot(TDirectoryName, NominalHists, DataHists, SystBand, PlotSuffix=PlotSuffix, OutputDir=cwd, PlotFormat=Args.PlotFormat)
+	PlotFile.Close()
+
+def NumbersExporter(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystSamples, DataSamples, EventVar, Numbers):
+	logging.info("---------------------------------")
+	logging.info("Beginning numbers only export")
+	logging.info("---------------------------------")
+	logging.info("Working with filename: " + str(Args.PlotFilename))
+
+	PlotFile = tfile(Args.PlotFilename)
+	logging.debug("Successfully opened plotting file")
+
+	# Same inputs as the plotter but nothing is drawn, we only keep the bin values
+	for TDirectoryName in TDirectoryNames:
+		logging.info("Gathering numbers for the TDirectoryName: " + TDirectoryName)
+		Numbers.setdefault(TDirectoryName, [])
+
+		for Obj in Objects:
+			for Var in Variables:
+				if EventVar:
+					NameCheck = Obj
+				else:
+					NameCheck = Obj+"_"+Var
+				logging.info("Gathering numbers for:\t" + NameCheck)
+
+				NominalHists = GetNominalContributions(PlotFile, TDirectoryName, NameCheck, NominalSamples)
+				DataHists = GetDataContributions(PlotFile, TDirectoryName, NameCheck, DataSamples)
+				if len(NominalHists) == 0 or len(DataHists) == 0:
+					logging.info("Missing nominal or data histograms for " + NameCheck + ", skipping")
+					continue
+				SystBand = CreateSystematicBand(PlotFile, TDirectoryName, NameCheck, NominalSamples+SystSamples)
+
+				Numbers[TDirectoryName].append(GetPlotNumbers(NameCheck, NominalSamples, NominalHists, DataHists, SystBand))
+	PlotFile.Close()
+
+def GetPlotNumbers(ObjVar, NominalSamples, NominalHists, DataHists, SystBand):
+	# Combine exactly as the plotter does so the numbers match the drawn PDFs
+	for Iter in range(0, len(NominalHists)):
+		if Iter == 0:
+			SMHist = NominalHists[Iter].Clone()
+		else:
+			SMHist.Add(NominalHists[Iter])
+	StatHist = SMHist.Clone()
+	SMHist = ApplySystematicBand(SMHist, SystBand)
+
+	for Iter in range(0, len(DataHists)):
+		if Iter == 0:
+			DataHist = DataHists[Iter].Clone()
+		else:
+			DataHist.Add(DataHists[Iter])
+
+	# The ratio band is built like DrawDataMCPad, dividing the SM total by itself.
+	# ROOT treats the two as uncorrelated, so this is sqrt(2) times SMError/SMTotal, as drawn
+	RatioBand = SMHist.Clone()
+	RatioBand.Divide(RatioBand)
+
+	Bins = range(1, SMHist.GetNbinsX()+1)
+	PlotNumbers = {}
+	PlotNumbers["ObjVar"] = ObjVar
+	PlotNumbers["XLow"] = [SMHist.GetXaxis().GetBinLowEdge(Bin) for Bin in Bins]
+	PlotNumbers["XHigh"] = [SMHist.GetXaxis().GetBinUpEdge(Bin) for Bin in Bins]
+	PlotNumbers["Samples"] = {}
+	for Sample in NominalSamples:
+		SampleName = ("_").join(Sample.split("_")[1:])
+		for Hist in NominalHists:
+			if Hist.GetName().endswith("_" + SampleName):
+				PlotNumbers["Samples"][SampleName] = [Hist.GetBinContent(Bin) for Bin in Bins]
+	PlotNumbers["SMTotal"] = [SMHist.GetBinContent(Bin) for Bin in Bins]
+	PlotNumbers["SMStatError"] = [StatHist.GetBinError(Bin) for Bin in Bins]
+	PlotNumbers["SMError"] = [SMHist.GetBinError(Bin) for Bin in Bins]
+	PlotNumbers["Data"] = [DataHist.GetBinContent(Bin) for Bin in Bins]
+	PlotNumbers["DataMC"] = []
+	PlotNumbers["DataMCBand"] = []
+	for Bin in Bins:
+		if SMHist.GetBinContent(Bin) != 0.0:
+			PlotNumbers["DataMC"].append(DataHist.GetBinContent(Bin)/SMHist.GetBinContent(Bin))
+		else:
+			PlotNumbers["DataMC"].append(0.0)
+		PlotNumbers["DataMCBand"].append(RatioBand.GetBinError(Bin))
+	return PlotNumbers
+
+def WriteNumbers(Args, Numbers, NominalSamples):
+	SampleNames = [("_").join(Sample.split("_")[1:]) for Sample in NominalSamples]
+	for TDirectoryName, PlotNumbersList in Numbers.items():
+		cwd = Args.OutputDir + TDirectoryName + "/"
+		if not os.path.exists(cwd):
+			os.makedirs(cwd)
+		OutputName = cwd + "Numbers." + Args.NumbersFormat
+		logging.info("Writing numbers to: " + OutputName)
+
+		if Args.NumbersFormat == "json":
+			WriteJsonAtomic(OutputName, dict((PlotNumbers["ObjVar"], PlotNumbers) for PlotNumbers in PlotNumbersList))
+			continue
+
+		with open(OutputName, "w") as OutputFile:
+			Writer = csv.writer(OutputFile)
+			Writer.writerow(["ObjVar", "Bin", "XLow", "XHigh"] + SampleNames + ["SMTotal", "SMStatError", "SMError", "Data", "DataMC", "DataMCBand"])
+			for PlotNumbers in PlotNumbersList:
+				for Index in range(0, len(PlotNumbers["SMTotal"])):
+					Row = [PlotNumbers["ObjVar"], Index+1, PlotNumbers["XLow"][Index], PlotNumbers["XHigh"][Index]]
+					for SampleName in SampleNames:
+						if SampleName in PlotNumbers["Samples"]:
+							Row.append(PlotNumbers["Samples"][SampleName][Index])
+						else:
+							Row.append("")
+					for Column in ["SMTotal", "SMStatError", "SMError", "Data", "DataMC", "DataMCBand"]:
+						Row.append(PlotNumbers[Column][Index])
+					Writer.writerow(Row)
+
+def GetPlotName(DataHist, PlotSuffix=""):
+	return "Final_"+DataHist.GetName().split("_nominal")[0]+PlotSuffix
+
+def GetPlotFingerprint(NominalHists, DataHists, SystBand, PlotSuffix, PlotFormat):
+	Fingerprint = hashlib.sha1()
+	for Hist in NominalHists + DataHists:
+		Fingerprint.update(Hist.GetName())
+		for Bin in range(0, Hist.GetNcells()):
+			Fingerprint.update(repr((Hist.GetBinLowEdge(Bin), Hist.GetBinContent(Bin), Hist.GetBinError(Bin))))
+	for i in range(0, SystBand.GetN()):
+		Fingerprint.update(repr((SystBand.GetPointX(i), SystBand.GetPointY(i))))
+	# Any change to the drawing code counts as a style change
+	for Function in [ExportPlot, DrawUncHist, DrawSMHists, DrawDataHists, RenameVarObj, DrawDataMCPad, CreateTopPad,
+			CreateBottomPad, SetTicks, DrawATLAS, CreateLegend, GetYAxisRange, ApplySystematicBand]:
+		Fingerprint.update(inspect.getsource(Function))
+	Fingerprint.update(PlotSuffix + "." + PlotFormat)
+	return Fingerprint.hexdigest()
+
+def SystematicBreakdown(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystSamples, EventVar, Breakdowns):
+	logging.info("---------------------------------")
+	logging.info("Beginning systematic breakdown")
+	logging.info("---------------------------------")
+	logging.info("Working with filename: " + str(Args.PlotFilename))
+
+	if not Args.NoBatch:
+		ROOT.gROOT.SetBatch()
+	PlotFile = tfile(Args.PlotFilename)
+
+	if EventVar:
+		NameChecks = list(Objects)
+	else:
+		NameChecks = [Obj+"_"+Var for Obj in Objects for Var in Variables]
+
+	for TDirectoryName in TDirectoryNames:
+		logging.info("Ranking systematics for the TDirectoryName: " + TDirectoryName)
+		Breakdowns.setdefault(TDirectoryName, [])
+		cwd = Args.OutputDir + TDirectoryName + "/"
+		if not os.path.exists(cwd):
+			os.makedirs(cwd)
+
+		for NameCheck in NameChecks:
+			# Longer obj names sharing this prefix, e.g. mu and mu_shifted, must not be picked up
+			LongerNames = [Other for Other in NameChecks if Other != NameCheck and Other.startswith(NameCheck + "_")]
+			SystNames, Groups, Contributions, BinEdges = GetSystematicsMatrix(PlotFile, TDirectoryName, NameCheck, LongerNames, NominalSamples, SystSamples)
+			if len(SystNames) == 0:
+				logging.info("No systematic graphs found for " + NameCheck + ", skipping")
+				continue
+			logging.info("Ranking " + str(len(SystNames)) + " systematics for " + NameCheck)
+
+			Breakdown = RankSystematics(SystNames, Groups, Contributions)
+			Breakdown["ObjVar"] = NameCheck
+			Breakdowns[TDirectoryName].append(Breakdown)
+			if Args.BreakdownPlot:
+				DrawBreakdown(Breakdown, BinEdges, cwd + "Breakdown_" + NameCheck + "." + Args.PlotFormat)
 	PlotFile.Close()
 
-def ExportPlot(TDirName, NominalHists, DataHists, SystBand, BatchMode = False):
+def GetSystematicsMatrix(RootFile, TDirectoryName, ObjVar, LongerNames, NominalSamples, SystSamples):
+	# Rows are every (sample, systematic) graph scaled to events, columns are the bins
+	Prefix = "Gr_" + TDirectoryName + "_" + ObjVar + "_"
+	SystNames = []
+	Groups = []
+	SampleMatrices = []
+	BinEdges = None
+	for Sample in NominalSamples + SystSamples:
+		SampleTDir = RootFile.Get(TDirectoryName + "/" + Sample)
+		if SampleTDir == None: continue
+		NomHist = SampleTDir.Get("h_" + TDirectoryName + "_" + ObjVar + "_nominal")
+		if NomHist == None: continue
+		# Graph point i belongs to bin i+1, so drop the under and overflow
+		Yields = HistToArray(NomHist)[1:-1]
+		if BinEdges == None:
+			BinEdges = [NomHist.GetXaxis().GetBinLowEdge(Bin) for Bin in range(1, NomHist.GetNbinsX()+2)]
+
+		SampleRows = []
+		for Key in SampleTDir.GetListOfKeys():
+			KeyName = Key.GetName()
+			if not KeyName.startswith(Prefix): continue
+			if any(KeyName.startswith("Gr_" + TDirectoryName + "_" + Other + "_") for Other in LongerNames): continue
+			SystName = KeyName[len(Prefix):]
+			if Sample in SystSamples:
+				# Alternative samples only carry their comparison to the nominal sample
+				if SystName != "tot_uncert": continue
+				SystName = Sample
+				Group = "Generator"
+			else:
+				if SystName == "tot_uncert": continue
+				if SystName.startswith("weight_"):
+					Group = "Weight"
+				else:
+					Group = "Tree"
+
+			Gr = Key.ReadObj()
+			RelUncert = BufferToArray(Gr.GetY(), Gr.GetN())
+			if len(RelUncert) != len(Yields):
+				logging.debug("Binning of " + KeyName + " does not match the nominal, skipping")
+				continue
+			SystNames.append(SystName)
+			Groups.append(Group)
+			SampleRows.append(RelUncert)
+
+		if len(SampleRows) != 0:
+			# Same convention as CreateSystematicBand, relative uncertainty times the sample's own yield
+			SampleMatrices.append(numpy.vstack(SampleRows) * Yields)
+
+	if len(SampleMatrices) == 0:
+		return [], [], None, BinEdges
+	return SystNames, Groups, numpy.vstack(SampleMatrices), BinEdges
+
+def RankSystematics(SystNames, Groups, Contributions):
+	# Samples are added in quadrature like the band, so the same systematic in several samples is merged on its squares
+	Squares = Contributions * Contributions
+	UniqueNames, NameIndices = numpy.unique(numpy.array(SystNames), return_inverse=True)
+	NameSquares = numpy.zeros((len(UniqueNames), Squares.shape[1]))
+	numpy.add.at(NameSquares, NameIndices, Squares)
+	NameGroups = [""] * len(UniqueNames)
+	for Index in range(0, len(SystNames)):
+		NameGroups[NameIndices[Index]] = Groups[Index]
+
+	UniqueGroups = sorted(set(Groups))
+	GroupIndices = numpy.array([UniqueGroups.index(Group) for Group in NameGroups])
+	GroupSquares = numpy.zeros((len(UniqueGroups), Squares.shape[1]))
+	numpy.add.at(GroupSquares, GroupIndices, NameSquares)
+
+	TotalSquares = NameSquares.sum(axis=0)
+	SafeTotal = numpy.where(TotalSquares > 0.0, TotalSquares, 1.0)
+	Breakdown = {}
+	Breakdown["Systematics"] = [str(Name) for Name in UniqueNames]
+	Breakdown["SystGroups"] = NameGroups
+	Breakdown["Groups"] = UniqueGroups
+	Breakdown["Total"] = numpy.sqrt(TotalSquares)
+	Breakdown["Contributions"] = numpy.sqrt(NameSquares)
+	Breakdown["Shares"] = NameSquares / SafeTotal
+	Breakdown["GroupContributions"] = numpy.sqrt(GroupSquares)
+	Breakdown["GroupShares"] = GroupSquares / SafeTotal
+	# Over the whole distribution each systematic is weighted by its summed variance
+	Breakdown["IntegratedShares"] = NameSquares.sum(axis=1) / max(TotalSquares.sum(), 1e-300)
+	Breakdown["IntegratedGroupShares"] = GroupSquares.sum(axis=1) / max(TotalSquares.sum(), 1e-300)
+	# Ranks for every bin at once, largest first
+	Breakdown["Ranking"] = numpy.argsort(-NameSquares, axis=0, kind="mergesort")
+	Breakdown["IntegratedRanking"] = numpy.argsort(-Breakdown["IntegratedShares"], kind="mergesort")
+	return Breakdown
+
+def WriteBreakdowns(Args, Breakdowns):
+	for TDirectoryName, BreakdownList in Breakdowns.items():
+		cwd = Args.OutputDir + TDirectoryName + "/"
+		OutputName = cwd + "Breakdown.csv"
+		logging.info("Writing systematic breakdown to: " + OutputName)
+		with open(OutputName, "w") as OutputFile:
+			Writer = csv.writer(OutputFile)
+			Writer.writerow(["ObjVar", "Bin", "Rank", "Systematic", "Group", "Contribution", "Share"])
+			for Breakdown in BreakdownList:
+				NTop = min(Args.BreakdownTop, len(Breakdown["Systematics"]))
+				for Rank in range(0, NTop):
+					Index = Breakdown["IntegratedRanking"][Rank]
+					Writer.writerow([Breakdown["ObjVar"], "All", Rank+1, Breakdown["Systematics"][Index], Breakdown["SystGroups"][Index], "", Breakdown["IntegratedShares"][Index]])
+				for Bin in range(0, len(Breakdown["Total"])):
+					for Rank in range(0, NTop):
+						Index = Breakdown["Ranking"][Rank][Bin]
+						Writer.writerow([Breakdown["ObjVar"], Bin+1, Rank+1, Breakdown["Systematics"][Index], Breakdown["SystGroups"][Index], Breakdown["Contributions"][Index][Bin], Breakdown["Shares"][Index][Bin]])
+
+		OutputName = cwd + "BreakdownGroups.csv"
+		logging.info("Writing group breakdown to: " + OutputName)
+		with open(OutputName, "w") as OutputFile:
+			Writer = csv.writer(OutputFile)
+			Writer.writerow(["ObjVar", "Bin", "Group", "Contribution", "Share"])
+			for Breakdown in BreakdownList:
+				for Index in range(0, len(Breakdown["Groups"])):
+					Writer.writerow([Breakdown["ObjVar"], "All", Breakdown["Groups"][Index], "", Breakdown["IntegratedGroupShares"][Index]])
+				for Bin in range(0, len(Breakdown["Total"])):
+					for Index in range(0, len(Breakdown["Groups"])):
+						Writer.writerow([Breakdown["ObjVar"], Bin+1, Breakdown["Groups"][Index], Breakdown["GroupContributions"][Index][Bin], Breakdown["GroupShares"][Index][Bin]])
+
+def DrawBreakdown(Breakdown, BinEdges, OutputName):
+	c = ROOT.TCanvas("c_breakdown", "", 800, 600)
+	c.cd()
+	gStyle.SetOptStat(0)
+
+	Legend = CreateLegend()
+	GroupStack = ROOT.THStack("GroupStack_" + Breakdown["ObjVar"], "")
+	# Built-in colours, the custom palette only exists while ExportPlot is running
+	GroupColours = {"Generator": ROOT.kAzure+1, "Weight": ROOT.kOrange+1, "Tree": ROOT.kGreen+2}
+	Edges = numpy.array(BinEdges, dtype=numpy.float64)
+	GroupHists = []
+	for Index in range(0, len(Breakdown["Groups"])):
+		Group = Breakdown["Groups"][Index]
+		GroupHist = ROOT.TH1D("h_breakdown_" + Breakdown["ObjVar"] + "_" + Group, "", len(Edges)-1, Edges)
+		for Bin in range(0, len(Edges)-1):
+			GroupHist.SetBinContent(Bin+1, Breakdown["GroupShares"][Index][Bin])
+		GroupHist.SetFillStyle(1001)
+		GroupHist.SetFillColor(GroupColours.get(Group, ROOT.kGray+1))
+		GroupHist.SetLineWidth(0)
+		GroupStack.Add(GroupHist)
+		Legend.AddEntry(GroupHist, Group)
+		GroupHists.append(GroupHist)
+
+	GroupStack.SetMaximum(1.4)
+	GroupStack.Draw("HIST")
+	GroupStack.GetYaxis().SetTitle("Fraction of syst. variance")
+	GroupStack.GetXaxis().SetTitle(Breakdown["ObjVar"])
+	Legend.Draw()
+	c.Update()
+	c.SaveAs(OutputName)
+	c.Close()
+
+def ExportPlot(TDirName, NominalHists, DataHists, SystBand, BatchMode = False, PlotSuffix = "", OutputDir = None, PlotFormat = "pdf"):
+	if OutputDir == None:
+		OutputDir = "Plots/" + TDirName + "/"
+
 	if BatchMode:
 		ROOT.gROOT.SetBatch()
 
@@ -113,6 +485,9 @@ def ExportPlot(TDirName, NominalHists, DataHists, SystBand, BatchMode = False):
 	colours["Wjets"]= TColor(3002,130./255, 95./255, 135./255)
 	colours["Zjets"]= TColor(3003,252./255, 176./255, 8./255)
 	colours["Diboson"]=TColor(3007,168./255, 164./255, 150./255)
+	colours["b-jets"]=TColor(3004,227./255, 26./255, 28./255)
+	colours["c-jets"]=TColor(3005,51./255, 160./255, 44./255)
+	colours["light-jets"]=TColor(3006,31./255, 120./255, 180./255)
 
 	# # Begin work on top pad
 	pad1 = CreateTopPad("pad1")
@@ -165,8 +540,8 @@ def ExportPlot(TDirName, NominalHists, DataHists, SystBand, BatchMode = False):
 	c.Update()
 	logging.info("Finished this plot!")
 
-	PlotName = "Final_"+DataHist.GetName().split("_nominal")[0]
-	c.SaveAs("Plots/" + TDirName + "/" + PlotName+".pdf")
+	PlotName = GetPlotName(DataHist, PlotSuffix)
+	c.SaveAs(OutputDir + PlotName + "." + PlotFormat)
 	if not BatchMode:
 		raw_input()
 
@@ -504,7 +879,164 @@ def GetNominalContributions(RootFile, TDirectoryName, ObjVar, NominalSamples):
 	logging.info("Finsihed getting all nominal contributions!")
 	return NomHists
 
-def CreateSystFile(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystSamples, DataSamples, EventVar):
+def GetFlavourContributions(RootFile, TDirectoryName, ObjVar, NominalSamples):
+	logging.info("Getting all the flavour histograms now ... ")
+	FlavourLabels = [("b", "b-jets"), ("c", "c-jets"), ("l", "light-jets")]
+	FlavHists = []
+	for Flavour, Label in FlavourLabels:
+		Iter = 0
+		for Sample in NominalSamples:
+			hist_name = TDirectoryName + "/" + Sample + "/Flavours/h_" + TDirectoryName + "_" + ObjVar + "_" + Flavour + "_nominal"
+			FlavSampleHist = RootFile.Get(hist_name)
+			if FlavSampleHist == None: continue
+			if Iter == 0:
+				# Named so DrawSMHists picks the label up as the sample name
+				FlavHist = FlavSampleHist.Clone("h_" + TDirectoryName + "_" + ObjVar + "_nominal_" + Label + "_Flavour")
+			else:
+				FlavHist.Add(FlavSampleHist)
+			Iter = Iter + 1
+		if Iter != 0:
+			logging.info("Got flavour histogram:\t" + Label)
+			FlavHists.append(FlavHist)
+	logging.info("Finished getting all flavour contributions!")
+	return FlavHists
+
+def CreateInputFiles(Args, TDirectoryNames, Plots, NominalSamples, SystSamples, DataSamples):
+	logging.info("---------------------------------------------------")
+	logging.info("Beginning input file creation from ntuples")
+	logging.info("---------------------------------------------------")
+	logging.info('Ntuple path is: ' + str(Args.NtuplePath))
+
+	Config = byteify(json.load(file(Args.Ntuples)))
+	logging.info("Loaded ntuple config")
+
+	# Every sample's event loops run multithreaded
+	ROOT.ROOT.EnableImplicitMT(Args.Threads)
+
+	# The (Obj, ObjVar) pairs the rest of the code expects to find histograms for
+	ObjVars = []
+	for Type, TypeDict in Plots.items():
+		for Obj in TypeDict["Objs"]:
+			for Var in TypeDict["Vars"]:
+				if Type == "Events":
+					ObjVar = Obj
+				else:
+					ObjVar = Obj+"_"+Var
+				if ObjVar not in Config["Histograms"]:
+					logging.info("No ntuple expression for " + ObjVar + ", skipping it")
+					continue
+				ObjVars.append((Obj, ObjVar))
+
+	# InputPath defaults to the shared production area, so never replace existing inputs by accident
+	ExistingFiles = []
+	for Sample in NominalSamples + SystSamples + DataSamples:
+		if len(glob.glob(Args.NtuplePath + Sample + "/" + Config["FilePattern"])) == 0: continue
+		for SystName in GetInputSystNames(Config, Sample, NominalSamples):
+			OutputName = Args.InputPath + Sample + "/" + Sample + "_" + SystName + "_combination.root"
+			if os.path.exists(OutputName):
+				ExistingFiles.append(OutputName)
+	if len(ExistingFiles) != 0:
+		if not Args.OverwriteInputs:
+			raise RuntimeError("{} input files already exist, e.g. {}! Use another --InputPath or pass --OverwriteInputs".format(len(ExistingFiles), ExistingFiles[0]))
+		logging.info("Overwriting " + str(len(ExistingFiles)) + " existing input files under " + Args.InputPath)
+
+	for Sample in NominalSamples + SystSamples + DataSamples:
+		logging.info("Working on sample: " + str(Sample))
+		NtupleFiles = sorted(glob.glob(Args.NtuplePath + Sample + "/" + Config["FilePattern"]))
+		if len(NtupleFiles) == 0:
+			logging.info("No ntuples found for " + Sample + ", skipping")
+			continue
+		logging.debug(NtupleFiles)
+
+		# Each tree is read once with every weight variation booked on the same loop
+		BookedHists = {}
+		if "data" in Sample:
+			BookedHists.update(BookSampleHistograms(Config, Config["TreeName"], NtupleFiles, TDirectoryNames, ObjVars, {"data": None}, True))
+		else:
+			Weights = {"nominal": Config["Weight"]}
+			if Sample in NominalSamples:
+				Weights.update(Config["WeightSysts"])
+			Weights.update(Config["SampleWeightSysts"].get(Sample, {}))
+			BookedHists.update(BookSampleHistograms(Config, Config["TreeName"], NtupleFiles, TDirectoryNames, ObjVars, Weights))
+
+			if Sample in NominalSamples:
+				for TreeSyst in Config["TreeSysts"]:
+					BookedHists.update(BookSampleHistograms(Config, TreeSyst, NtupleFiles, TDirectoryNames, ObjVars, {TreeSyst: Config["Weight"]}))
+
+		AllResults = [Result for SystResults in BookedHists.values() for TDir, Result in SystResults]
+		logging.info("Running event loops for " + str(len(AllResults)) + " histograms ...")
+		if hasattr(ROOT.RDF, "RunGraphs"):
+			# Run the loops over all trees of the sample concurrently
+			ROOT.RDF.RunGraphs(AllResults)
+
+		OutputPath = Args.InputPath + Sample + "/"
+		if not os.path.exists(OutputPath):
+			os.makedirs(OutputPath)
+		for SystName, SystResults in BookedHists.items():
+			OutputName = OutputPath + Sample + "_" + SystName + "_combination.root"
+			logging.debug("Writing histograms to: " + OutputName)
+			OutFile = tfile(OutputName, "RECREATE")
+			for TDirectoryName in TDirectoryNames:
+				OutFile.mkdir(TDirectoryName)
+			for TDirectoryName, Result in SystResults:
+				OutFile.cd(TDirectoryName)
+				Result.GetValue().Write()
+			OutFile.Close()
+		logging.info("Written " + str(len(BookedHists)) + " input files for " + Sample)
+
+def GetInputSystNames(Config, Sample, NominalSamples):
+	# Every _combination.root file CreateInputFiles writes for a sample
+	if "data" in Sample:
+		return ["data"]
+	SystNames = ["nominal"]
+	if Sample in NominalSamples:
+		SystNames = SystNames + list(Config["WeightSysts"].keys()) + list(Config["TreeSysts"])
+	return SystNames + list(Config["SampleWeightSysts"].get(Sample, {}).keys())
+
+def BookSampleHistograms(Config, TreeName, NtupleFiles, TDirectoryNames, ObjVars, Weights, IsData=False):
+	# Only books the histograms, nothing is read until the first result is requested
+	Files = ROOT.std.vector("string")()
+	for NtupleFile in NtupleFiles:
+		Files.push_back(NtupleFile)
+	Frame = ROOT.RDataFrame(TreeName, Files)
+
+	for Obj, ObjVar in ObjVars:
+		Frame = Frame.Define("var_" + ObjVar, Config["Histograms"][ObjVar]["Expr"])
+	WeightColumns = {}
+	for SystName, Weight in Weights.items():
+		if Weight == None:
+			WeightColumns[SystName] = None
+			continue
+		WeightColumns[SystName] = "w_" + SystName
+		Frame = Frame.Define(WeightColumns[SystName], Weight)
+
+	BookedHists = dict((SystName, []) for SystName in Weights)
+	for TDirectoryName in TDirectoryNames:
+		ChannelFrame = Frame.Filter(Config["Channels"][TDirectoryName], TDirectoryName)
+		ObjFlavFrames = {}
+		for Obj, ObjVar in ObjVars:
+			if IsData:
+				# Data has no flavour split
+				FlavFrames = [("data", ChannelFrame)]
+			else:
+				if Obj not in ObjFlavFrames:
+					Flavours = Config["Flavours"].get(Obj, Config["Flavours"]["Default"])
+					ObjFlavFrames[Obj] = [(Flav, ChannelFrame.Filter(Flavours[Flav])) for Flav in ["b", "c", "l"]]
+				FlavFrames = ObjFlavFrames[Obj]
+
+			Bins = Config["Histograms"][ObjVar]["Bins"]
+			for Flav, FlavFrame in FlavFrames:
+				HistName = "h_" + TDirectoryName + "_" + ObjVar + "_" + Flav
+				Model = ROOT.RDF.TH1DModel(HistName, "", Bins[0], Bins[1], Bins[2])
+				for SystName, WeightColumn in WeightColumns.items():
+					if WeightColumn == None:
+						Result = FlavFrame.Histo1D(Model, "var_" + ObjVar)
+					else:
+						Result = FlavFrame.Histo1D(Model, "var_" + ObjVar, WeightColumn)
+					BookedHists[SystName].append((TDirectoryName, Result))
+	return BookedHists
+
+def CreateSystFile(Args, TDirectoryNames, Objects, Variables, NominalSamples, SystSamples, DataSamples, EventVar, Journal=None, Pruning=None, Catalog=None):
 	logging.info("---------------------------------------------------")
 	logging.info("Beginning file creation needed for plotting")
 	logging.info("---------------------------------------------------")
@@ -541,7 +1073,10 @@ def CreateSystFile(Args, TDirectoryNames, Objects, Variables, NominalSamples, Sy
 
 			# Get a list of the systematic files
 			if not "data" in Sample and Sample != "FTAG2_ttbar_PhPy8_hdamp3mtop":
-				SystFiles = [f for f in os.listdir(base) if "FTAG2_" in f]
+				if Catalog != None:
+					SystFiles = [f for f in CatalogFiles(Catalog, Sample) if "FTAG2_" in f]
+				else:
+					SystFiles = [f for f in os.listdir(base) if "FTAG2_" in f]
 				SystFiles.remove(nominal_file)
 				# if Sample == "FTAG2_ttbar_PhPy8":
 				# 	bad_file = "FTAG2_ttbar_PhPy8_weight_mc_shower_np_131_combination.root"
@@ -549,7 +1084,7 @@ def CreateSystFile(Args, TDirectoryNames, Objects, Variables, NominalSamples, Sy
 			else:
 				SystFiles = []
 
-			CompletedMethod = CalculateSystematics(NomFile, SystFiles, TDirectoryName, base, OutFile, Sample, Objects, Variables, EventVar)
+			CompletedMethod = CalculateSystematics(NomFile, SystFiles, TDirectoryName, base, OutFile, Sample, Objects, Variables, EventVar, Journal, Pruning, not Args.NoFlavours, Catalog)
 			if not CompletedMethod:
 				logging.info("Removing sample with missing histograms "+str(Sample))
 				AllInputDirsClone.remove(Sample)
@@ -557,6 +1092,7 @@ def CreateSystFile(Args, TDirectoryNames, Objects, Variables, NominalSamples, Sy
 			NomFile.Close()
 		OutFile.cd(TDirectoryName)
 		OutFile.Write('', ROOT.TObject.kOverwrite)
+	WritePruningReport(Pruning)
 
 	logging.info("-----------------------------------------")
 	logging.info("Now calculating each total uncertainty ...")
@@ -565,6 +1101,10 @@ def CreateSystFile(Args, TDirectoryNames, Objects, Variables, NominalSamples, Sy
 		logging.info("Creating syst band for the TDirectoryName: " + TDirectoryName)
 		for Sample in AllInputDirsClone:
 			if "data" in Sample: continue
+			UnitKey = JournalUnitKey(TDirectoryName, Sample, "tot_uncert", Objects)
+			if IsUnitComplete(Journal, UnitKey):
+				logging.info("Total uncertainty already completed for " + Sample + ", skipping")
+				continue
 			for Obj in Objects:
 				logging.info("And object " + Obj)
 				for Var in Variables:
@@ -575,6 +1115,7 @@ def CreateSystFile(Args, TDirectoryNames, Objects, Variables, NominalSamples, Sy
 					else:
 						logging.debug("Calcating a combined tree based systematic uncertainty")
 						CalculateSampleUncertainty(OutFile, TDirectoryName, Obj, Var, Sample, EventVar, False)
+			CommitUnit(OutFile, Journal, UnitKey, TDirectoryName + "/" + Sample)
 	OutFile.Close()
 
 def CalculateSampleUncertainty(RootFile, TDirectoryName, Object, Variable, Sample, EventVar, CalculateSystSamp=False, FilePath = False):
@@ -592,7 +1133,7 @@ def CalculateSampleUncertainty(RootFile, TDirectoryName, Object, Variable, Sampl
 		CurrentTDir = RootFile.Get(TDirectoryName + "/" + Sample)
 		Iter = 0
 		for Key in CurrentTDir.GetListOfKeys():
-			if (NameCheck) in Key.GetName() and "nominal" not in Key.GetName():
+			if (NameCheck) in Key.GetName() and "nominal" not in Key.GetName() and "tot_uncert" not in Key.GetName():
 				logging.debug("Found graph " + str(Key.GetName()))
 
 				SystGr = CurrentTDir.Get(Key.GetName()).Clone()
@@ -607,6 +1148,16 @@ def CalculateSampleUncertainty(RootFile, TDirectoryName, Object, Variable, Sampl
 						UncGr.SetPointY(i, UncGr.GetPointY(i)+(SystGr.GetPointY(i)*SystGr.GetPointY(i)))
 				Iter = Iter + 1
 
+		if Iter == 0:
+			# Happens when every systematic was pruned away
+			logging.info("No systematic graphs found for " + NameCheck + ", not writing a total uncertainty")
+			# The output is updated in place, so a total from an earlier unpruned run must not survive.
+			# Covers both the name written below and the one CreateSystematicBand reads
+			StaleNames = [("_").join(("Gr_" + TDirectoryName).split("_")[:3]+[NameCheck,"tot_uncert"]), "Gr_" + TDirectoryName + "_" + NameCheck + "_tot_uncert"]
+			RootFile.cd(TDirectoryName + "/" + Sample)
+			DeleteObjects(gDirectory, list(set(StaleNames)))
+			return None
+
 		logging.debug("Sqaure-rooting the summed histograms ... ")
 		for i in range(0, UncGr.GetN()):
 			# Add in quadrature
@@ -665,7 +1216,7 @@ def CalculateSampleUncertainty(RootFile, TDirectoryName, Object, Variable, Sampl
 		RootFile.cd(TDirectoryName + "/" + Sample)
 		UncHist.Write('', ROOT.TObject.kOverwrite)
 
-def CalculateSystematics(NominalFile, SystematicFiles, TDirectory, PathToFiles, OutputFile, Sample, Objs, Vars, EventVar):
+def CalculateSystematics(NominalFile, SystematicFiles, TDirectory, PathToFiles, OutputFile, Sample, Objs, Vars, EventVar, Journal=None, Pruning=None, KeepFlavours=True, Catalog=None):
 	NomTDir = NominalFile.Get(TDirectory)
 
 	NominalHists = GetGoodListOfHistograms(Objs, Vars, NomTDir, TDirectory, Sample, EventVar)
@@ -674,6 +1225,8 @@ def CalculateSystematics(NominalFile, SystematicFiles, TDirectory, PathToFiles,
 	if len(NominalHists) != 0:
 		# Ensure we have results to work with
 		Objs = list(dict.fromkeys(Objs))
+		# Group the histograms for every obj and var first so each systematic file is only opened once
+		AllHistMatches = []
 		for Obj in Objs:
 			# Can now group them and add them
 			logging.info("Organising histograms for the object " + Obj)
@@ -698,31 +1251,103 @@ def CalculateSystematics(NominalFile, SystematicFiles, TDirectory, PathToFiles,
 				logging.debug("Regex search string: " + SearchString)
 				logging.debug("Found matches after regex search:")
 				logging.debug(HistMatches)
+				AllHistMatches.append(HistMatches)
+
+		logging.debug("About to create nominal added histograms")
+		NomHists = [GetAddedHistogram(HistMatches, NomTDir) for HistMatches in AllHistMatches]
+		# Also keep the b/c/light components next to the sum so flavour stacked plots need no extra pass
+		KeepFlavours = KeepFlavours and not "data" in Sample
+		if KeepFlavours:
+			NomFlavHists = [GetFlavourHistograms(HistMatches, NomTDir) for HistMatches in AllHistMatches]
+		UnitKey = JournalUnitKey(TDirectory, Sample, NominalFile.GetName().split("/")[-1], Objs)
+		if not IsUnitComplete(Journal, UnitKey):
+			OutputFile.cd(TDirectory + "/" + Sample)
+			for NomHist in NomHists:
+				NomHist.Write('', ROOT.TObject.kOverwrite)
+			if KeepFlavours:
+				CdFlavourDirectory(OutputFile, TDirectory, Sample)
+				for FlavHists in NomFlavHists:
+					for FlavHist in FlavHists:
+						FlavHist.Write('', ROOT.TObject.kOverwrite)
+			CommitUnit(OutputFile, Journal, UnitKey, TDirectory + "/" + Sample)
+
+		if not "data" in Sample:
+			if Pruning != None:
+				# Graphs written before an interruption still count when looking for duplicates
+				CompletedNames = [File.split(".root")[0].split(Sample+"_")[1].split("_combination")[0] for File in SystematicFiles if IsUnitComplete(Journal, JournalUnitKey(TDirectory, Sample, File, Objs))]
+				AllNomHists = list(NomHists)
+				if KeepFlavours:
+					AllNomHists = AllNomHists + [FlavHist for FlavHists in NomFlavHists for FlavHist in FlavHists]
+				SeedDuplicateSystematics(Pruning, OutputFile, TDirectory, Sample, AllNomHists, CompletedNames)
+
+			for File in SystematicFiles:
+				UnitKey = JournalUnitKey(TDirectory, Sample, File, Objs)
+				if IsUnitComplete(Journal, UnitKey):
+					logging.info("Already completed systematic file, skipping:\t" + File)
+					continue
+
+				# The catalog tells us which histograms a file has without opening it
+				HistIndices = range(0, len(AllHistMatches))
+				CatalogEntry = GetCatalogEntry(Catalog, Sample, File)
+				if CatalogEntry != None:
+					CatalogKeys = set(CatalogEntry["TDirs"].get(TDirectory, []))
+					HistIndices = [Index for Index in HistIndices if set(AllHistMatches[Index]).issubset(CatalogKeys)]
+					if len(HistIndices) != len(AllHistMatches):
+						logging.info("Catalog has missing histograms in " + File + ", only using " + str(len(HistIndices)) + " of " + str(len(AllHistMatches)))
+					if len(HistIndices) == 0:
+						CommitUnit(OutputFile, Journal, UnitKey, TDirectory + "/" + Sample)
+						continue
+
+				# Now compare every systematic to the nominal
+				SystFile = tfile(PathToFiles+File)
+				SystematicName = File.split(".root")[0].split(Sample+"_")[1].split("_combination")[0]
+				if SystFile == None: continue
+				logging.debug("Successfully opened systematic file: " + File)
+				logging.info("Including systematic:\t" + SystematicName)
+				if len(SystFile.GetListOfKeys()) == 0:
+					SystFile.Close()
+					CommitUnit(OutputFile, Journal, UnitKey, TDirectory + "/" + Sample)
+					continue
+				SystTDir = SystFile.Get(TDirectory)
+
+				UncGrs = []
+				FlavUncGrs = []
+				PrunedNames = []
+				FlavPrunedNames = []
+				for Index in HistIndices:
+					HistMatches = AllHistMatches[Index]
+					NomHist = NomHists[Index]
+					# Get the systematic hist and calculate uncert w.r.t to nominal
+					logging.debug("About to create systematic added histogram")
+					SystHist = GetAddedHistogram(HistMatches, SystTDir, SystematicName)
+					logging.debug("About to create uncertainty graph")
+					UncGr = GetUncertaintyGr(NomHist, SystHist)
+					if KeepSystematic(Pruning, TDirectory, Sample, NomHist, SystHist, UncGr):
+						UncGrs.append(UncGr)
+					else:
+						PrunedNames.append(UncGr.GetName())
+
+					if not KeepFlavours: continue
+					SystFlavHists = GetFlavourHistograms(HistMatches, SystTDir, SystematicName)
+					for NomFlavHist, SystFlavHist in zip(NomFlavHists[Index], SystFlavHists):
+						FlavUncGr = GetUncertaintyGr(NomFlavHist, SystFlavHist)
+						if KeepSystematic(Pruning, TDirectory, Sample, NomFlavHist, SystFlavHist, FlavUncGr):
+							FlavUncGrs.append(FlavUncGr)
+						else:
+							FlavPrunedNames.append(FlavUncGr.GetName())
 
-				logging.debug("About to create nominal added histogram")
-				NomHist = GetAddedHistogram(HistMatches, NomTDir)
 				OutputFile.cd(TDirectory + "/" + Sample)
-				NomHist.Write('', ROOT.TObject.kOverwrite)
-				if not "data" in Sample:
-					for File in SystematicFiles:
-						# Now compare every systematic to the nominal
-						SystFile = tfile(PathToFiles+File)
-						SystematicName = File.split(".root")[0].split(Sample+"_")[1].split("_combination")[0]
-						if SystFile == None: continue
-						logging.debug("Successfully opened systematic file: " + File)
-						logging.info("Including systematic:\t" + SystematicName)
-						if len(SystFile.GetListOfKeys()) == 0: continue
-						SystTDir = SystFile.Get(TDirectory)
-
-						# Get the systematic hist and calculate uncert w.r.t to nominal
-						logging.debug("About to create systematic added histogram")
-						SystHist = GetAddedHistogram(HistMatches, SystTDir, SystematicName)
-						logging.debug("About to create uncertainty graph")
-						UncGr = GetUncertaintyGr(NomHist, SystHist)
-
-						OutputFile.cd(TDirectory + "/" + Sample)
-						UncGr.Write('', ROOT.TObject.kOverwrite)
-						SystFile.Close()
+				for UncGr in UncGrs:
+					UncGr.Write('', ROOT.TObject.kOverwrite)
+				# The output is updated in place, so drop pruned graphs left by an earlier unpruned run
+				DeleteObjects(gDirectory, PrunedNames)
+				if KeepFlavours:
+					CdFlavourDirectory(OutputFile, TDirectory, Sample)
+					for FlavUncGr in FlavUncGrs:
+						FlavUncGr.Write('', ROOT.TObject.kOverwrite)
+					DeleteObjects(gDirectory, FlavPrunedNames)
+				SystFile.Close()
+				CommitUnit(OutputFile, Journal, UnitKey, TDirectory + "/" + Sample)
 		return True
 	else:
 		logging.info("No histograms found in file, bad file!")
@@ -778,6 +1403,24 @@ def GetAddedHistogram(InputHists, TDirectory, SystName="nominal"):
 	Hist.SetTitle("")
 	return Hist
 
+def GetFlavourHistograms(InputHists, TDirectory, SystName="nominal"):
+	# Same as GetAddedHistogram but each b, c and light histogram is kept separately
+	FlavHists = []
+	for InputHist in InputHists:
+		Flavour = InputHist.split("_")[-1]
+		if Flavour not in ["b", "c", "l"]: continue
+		logging.debug("Creating flavour histogram from " + str(InputHist))
+		Hist = TDirectory.Get(InputHist).Clone(InputHist + "_" + SystName)
+		Hist.SetTitle("")
+		FlavHists.append(Hist)
+	return FlavHists
+
+def CdFlavourDirectory(RootFile, TDirectoryName, Sample):
+	RootFile.cd(TDirectoryName + "/" + Sample)
+	if gDirectory.GetDirectory("Flavours") == None:
+		gDirectory.mkdir("Flavours")
+	RootFile.cd(TDirectoryName + "/" + Sample + "/Flavours")
+
 def GetGoodListOfHistograms(Objects, Variables, TDirectory, TDirectoryName, Sample, EventVar):
 	NominalHists = []
 	for key in TDirectory.GetListOfKeys():
@@ -809,6 +1452,115 @@ def GetGoodListOfHistograms(Objects, Variables, TDirectory, TDirectoryName, Samp
 	logging.debug(NominalHists)
 	return NominalHists
 
+def CompareFiles(Args):
+	logging.info("---------------------------------")
+	logging.info("Comparing output files")
+	logging.info("---------------------------------")
+	RefName, TargetName = Args.Compare
+	logging.info("Reference:\t" + RefName)
+	logging.info("Target:\t\t" + TargetName)
+
+	RefFile = tfile(RefName)
+	TargetFile = tfile(TargetName)
+	RefArrays = {}
+	TargetArrays = {}
+	RefAxes = {}
+	TargetAxes = {}
+	LoadObjectArrays(RefFile, "", RefArrays, RefAxes)
+	LoadObjectArrays(TargetFile, "", TargetArrays, TargetAxes)
+	RefFile.Close()
+	TargetFile.Close()
+	logging.info("Loaded " + str(len(RefArrays)) + " reference and " + str(len(TargetArrays)) + " target objects")
+
+	Report = {"AbsTol": Args.AbsTol, "RelTol": Args.RelTol, "MissingInTarget": [], "MissingInReference": [], "BinningChanged": [], "Objects": {}}
+	Report["MissingInTarget"] = sorted(set(RefArrays) - set(TargetArrays))
+	Report["MissingInReference"] = sorted(set(TargetArrays) - set(RefArrays))
+	Common = sorted(set(RefArrays) & set(TargetArrays))
+	# Histogram bin edges and graph x values have to be identical for a bin by bin comparison to mean anything
+	Report["BinningChanged"] = [Name for Name in Common if len(RefArrays[Name]) != len(TargetArrays[Name]) or not numpy.array_equal(RefAxes[Name], TargetAxes[Name])]
+	Common = [Name for Name in Common if len(RefArrays[Name]) != 0 and Name not in Report["BinningChanged"]]
+
+	Failures = []
+	if len(Common) != 0:
+		# Compare everything at once and reduce per object
+		Ref = numpy.concatenate([RefArrays[Name] for Name in Common])
+		Target = numpy.concatenate([TargetArrays[Name] for Name in Common])
+		Offsets = numpy.cumsum([0] + [len(RefArrays[Name]) for Name in Common[:-1]])
+
+		# A nan in both files counts as agreement, a nan in only one as a difference
+		BothNaN = numpy.isnan(Ref) & numpy.isnan(Target)
+		AbsDiff = numpy.abs(Target - Ref)
+		AbsDiff[BothNaN] = 0.0
+		Scale = numpy.abs(Ref)
+		RelDiff = numpy.where(Scale > 0.0, AbsDiff / numpy.where(Scale > 0.0, Scale, 1.0), numpy.where(AbsDiff > 0.0, numpy.inf, 0.0))
+		Outside = ~(AbsDiff <= Args.AbsTol + Args.RelTol * Scale) & ~BothNaN
+
+		MaxAbs = numpy.maximum.reduceat(AbsDiff, Offsets)
+		MaxRel = numpy.maximum.reduceat(RelDiff, Offsets)
+		NOutside = numpy.add.reduceat(Outside.astype(numpy.int64), Offsets)
+		for Index in range(0, len(Common)):
+			Report["Objects"][Common[Index]] = {"MaxAbsDiff": float(MaxAbs[Index]), "MaxRelDiff": float(MaxRel[Index]), "BinsOutside": int(NOutside[Index])}
+			if NOutside[Index] != 0:
+				Failures.append(Common[Index])
+
+	Failures.sort(key=lambda Name: Report["Objects"][Name]["MaxRelDiff"], reverse=True)
+	for Name in Failures:
+		logging.info("Differs:\t" + Name + "\tmax abs " + str(Report["Objects"][Name]["MaxAbsDiff"]) + "\tmax rel " + str(Report["Objects"][Name]["MaxRelDiff"]))
+	for Name in Report["MissingInTarget"]:
+		logging.info("Missing in target:\t" + Name)
+	for Name in Report["MissingInReference"]:
+		logging.info("Missing in reference:\t" + Name)
+	for Name in Report["BinningChanged"]:
+		logging.info("Binning changed:\t" + Name)
+	logging.info("Compared " + str(len(Common)) + " objects, " + str(len(Failures)) + " outside tolerance")
+
+	if Args.CompareReport:
+		Report["Failures"] = Failures
+		WriteJsonAtomic(Args.CompareReport, Report)
+		logging.info("Comparison report written to: " + Args.CompareReport)
+	return len(Failures) + len(Report["MissingInTarget"]) + len(Report["MissingInReference"]) + len(Report["BinningChanged"]) == 0
+
+def LoadObjectArrays(Directory, Prefix, Arrays, Axes):
+	# Walks every TDirectory and keeps histogram contents and graph points as arrays,
+	# along with the bin edges or graph x values they belong to
+	for Key in Directory.GetListOfKeys():
+		KeyClass = ROOT.TClass.GetClass(Key.GetClassName())
+		Name = Prefix + Key.GetName()
+		if KeyClass.InheritsFrom("TDirectory"):
+			LoadObjectArrays(Directory.Get(Key.GetName()), Name + "/", Arrays, Axes)
+		elif KeyClass.InheritsFrom("TH1"):
+			Hist = Key.ReadObj()
+			Arrays[Name] = HistToArray(Hist)
+			Axes[Name] = AxisToArray(Hist.GetXaxis())
+		elif KeyClass.InheritsFrom("TGraph"):
+			Gr = Key.ReadObj()
+			Arrays[Name] = BufferToArray(Gr.GetY(), Gr.GetN())
+			Axes[Name] = BufferToArray(Gr.GetX(), Gr.GetN())
+
+def AxisToArray(Axis):
+	# Variable binning keeps its edges, fixed binning only stores the range
+	if Axis.GetXbins().GetSize() > 0:
+		return BufferToArray(Axis.GetXbins().GetArray(), Axis.GetXbins().GetSize())
+	return numpy.linspace(Axis.GetXmin(), Axis.GetXmax(), Axis.GetNbins()+1)
+
+def HistToArray(Hist):
+	NCells = Hist.GetNcells()
+	if Hist.InheritsFrom("TArrayD"):
+		return BufferToArray(Hist.GetArray(), NCells)
+	elif Hist.InheritsFrom("TArrayF"):
+		return BufferToArray(Hist.GetArray(), NCells, numpy.float32).astype(numpy.float64)
+	return numpy.array([Hist.GetBinContent(Bin) for Bin in range(0, NCells)], dtype=numpy.float64)
+
+def BufferToArray(Buffer, Size, DType=numpy.float64):
+	if Size == 0:
+		return numpy.zeros(0, dtype=DType)
+	# PyROOT buffers do not know their length until told
+	if hasattr(Buffer, "SetSize"):
+		Buffer.SetSize(Size)
+	elif hasattr(Buffer, "reshape"):
+		Buffer.reshape((Size,))
+	return numpy.array(numpy.frombuffer(Buffer, dtype=DType, count=Size))
+
 def LogDebuggingHistInfo(Histogram, HistogramType):
 	# HistogramTypes: "nom", "syst"
 	if HistogramType == "nom":
@@ -822,6 +1574,198 @@ def LogDebuggingHistInfo(Histogram, HistogramType):
 	logging.debug("\nName:\t" + str(Histogram.GetName()) + "\nType:\t" + str(type(Histogram)) + "\nObject:\t" + str(Histogram))
 	logging.debug("----------------------------------------------------------------------------------------------")
 
+def OpenJournal(Args):
+	# The journal lives next to the output file and records every completed
+	# (channel, sample, systematic file) unit of a --CreateFile run
+	Path = os.path.splitext(Args.OutputFile)[0] + "_journal.json"
+	Journal = {"Path": Path, "OutputFile": Args.OutputFile, "Completed": set()}
+	if Args.Resume and os.path.exists(Path):
+		Journal["Completed"] = set(byteify(json.load(file(Path)))["Completed"])
+		logging.info("Resuming from journal " + Path + " with " + str(len(Journal["Completed"])) + " completed units")
+	else:
+		if Args.Resume:
+			logging.info("No journal found at " + Path + ", starting from scratch")
+		WriteJsonAtomic(Path, {"OutputFile": Args.OutputFile, "Completed": []})
+	return Journal
+
+def JournalUnitKey(TDirectoryName, Sample, File, Objects):
+	return "/".join([TDirectoryName, Sample, File, "+".join(Objects)])
+
+def IsUnitComplete(Journal, UnitKey):
+	if Journal == None:
+		return False
+	return UnitKey in Journal["Completed"]
+
+def CommitUnit(OutputFile, Journal, UnitKey, DirectoryName):
+	# Only record the unit once everything it wrote is safely on disk.
+	# A unit only touches one sample directory, so only that one and the key lists above it are written
+	OutputFile.GetDirectory(DirectoryName).Write('', ROOT.TObject.kOverwrite)
+	ParentName = DirectoryName
+	while "/" in ParentName:
+		ParentName = ParentName.rsplit("/", 1)[0]
+		OutputFile.GetDirectory(ParentName).SaveSelf(True)
+	OutputFile.SaveSelf(True)
+	OutputFile.Flush()
+	if Journal == None:
+		return
+	Journal["Completed"].add(UnitKey)
+	WriteJsonAtomic(Journal["Path"], {"OutputFile": Journal["OutputFile"], "Completed": sorted(Journal["Completed"])})
+	logging.debug("Committed unit to journal: " + UnitKey)
+
+def WriteJsonAtomic(Path, Data):
+	# Write to a temporary file and rename so a crash never leaves a half written file
+	TmpPath = Path + ".tmp"
+	with open(TmpPath, "w") as TmpFile:
+		json.dump(Data, TmpFile, indent=4, sort_keys=True)
+		TmpFile.flush()
+		os.fsync(TmpFile.fileno())
+	os.rename(TmpPath, Path)
+
+def OpenCatalog(Args, Samples):
+	# The catalog records size, mtime, TDirectories and keys of every input file
+	Catalog = {"InputPath": Args.InputPath, "Files": {}}
+	if os.path.exists(Args.Catalog):
+		StoredCatalog = byteify(json.load(file(Args.Catalog)))
+		if StoredCatalog["InputPath"] == Args.InputPath:
+			Catalog = StoredCatalog
+		else:
+			logging.info("Catalog was built for " + StoredCatalog["InputPath"] + ", rebuilding")
+
+	NIndexed = 0
+	for Sample in Samples:
+		base = Args.InputPath + Sample + "/"
+		if not os.path.exists(base):
+			logging.debug("No input directory for " + Sample)
+			continue
+		InputFiles = [f for f in os.listdir(base) if f.endswith(".root")]
+
+		# Forget files that have since been removed
+		for CatalogName in Catalog["Files"].keys():
+			if CatalogName.split("/")[0] == Sample and CatalogName.split("/")[1] not in InputFiles:
+				del Catalog["Files"][CatalogName]
+
+		for InputFile in InputFiles:
+			FileStat = os.stat(base + InputFile)
+			CatalogEntry = Catalog["Files"].get(Sample + "/" + InputFile)
+			if CatalogEntry != None and CatalogEntry["Size"] == FileStat.st_size and CatalogEntry["MTime"] == FileStat.st_mtime:
+				continue
+			logging.debug("Indexing input file: " + InputFile)
+			CatalogEntry = IndexInputFile(base + InputFile)
+			if CatalogEntry == None:
+				Catalog["Files"].pop(Sample + "/" + InputFile, None)
+				continue
+			CatalogEntry["Size"] = FileStat.st_size
+			CatalogEntry["MTime"] = FileStat.st_mtime
+			Catalog["Files"][Sample + "/" + InputFile] = CatalogEntry
+			NIndexed = NIndexed + 1
+
+	logging.info("Catalog has " + str(len(Catalog["Files"])) + " input files, (re)indexed " + str(NIndexed))
+	WriteJsonAtomic(Args.Catalog, Catalog)
+	return Catalog
+
+def IndexInputFile(FilePath):
+	InFile = tfile(FilePath)
+	if InFile == None:
+		# Broken files are left out so they are retried next time
+		return None
+	CatalogEntry = {"Keys": [], "TDirs": {}}
+	for Key in InFile.GetListOfKeys():
+		CatalogEntry["Keys"].append(Key.GetName())
+		if ROOT.TClass.GetClass(Key.GetClassName()).InheritsFrom("TDirectory"):
+			CatalogEntry["TDirs"][Key.GetName()] = [SubKey.GetName() for SubKey in InFile.Get(Key.GetName()).GetListOfKeys()]
+	InFile.Close()
+	return CatalogEntry
+
+def CatalogFiles(Catalog, Sample):
+	return sorted([CatalogName.split("/")[1] for CatalogName in Catalog["Files"] if CatalogName.split("/")[0] == Sample])
+
+def GetCatalogEntry(Catalog, Sample, File):
+	if Catalog == None:
+		return None
+	return Catalog["Files"].get(Sample + "/" + File)
+
+def OpenPruning(Args):
+	if not Args.Prune:
+		return None
+	Path = os.path.splitext(Args.OutputFile)[0] + "_pruning.json"
+	Pruning = {"Path": Path, "AbsThreshold": Args.PruneAbs, "RelThreshold": Args.PruneRel, "FlagOnly": Args.PruneFlagOnly, "Report": {}, "Seen": {}}
+	if Args.Resume and os.path.exists(Path):
+		# Keep what the interrupted run already pruned
+		Pruning["Report"] = byteify(json.load(file(Path)))["Report"]
+	logging.info("Pruning systematics below " + str(Args.PruneAbs) + " events or " + str(Args.PruneRel) + " relative in every bin")
+	return Pruning
+
+def KeepSystematic(Pruning, TDirectoryName, Sample, NominalHist, SystematicHist, UncertaintyGr):
+	if Pruning == None:
+		return True
+	SampleReport = Pruning["Report"].setdefault(TDirectoryName, {}).setdefault(Sample, {"Negligible": [], "Duplicates": {}})
+	GrName = UncertaintyGr.GetName()
+
+	Negligible = True
+	for i in range(0, UncertaintyGr.GetN()):
+		AbsShift = abs(SystematicHist.GetBinContent(i+1) - NominalHist.GetBinContent(i+1))
+		RelShift = abs(UncertaintyGr.GetPointY(i))
+		if AbsShift > Pruning["AbsThreshold"] and RelShift > Pruning["RelThreshold"]:
+			Negligible = False
+			break
+	if Negligible:
+		logging.info("Negligible systematic:\t" + GrName)
+		if GrName not in SampleReport["Negligible"]:
+			SampleReport["Negligible"].append(GrName)
+		return Pruning["FlagOnly"]
+
+	# Identical shifts are only counted once, keyed on the nominal so each obj and var is separate
+	SeenGrs = Pruning["Seen"].setdefault(PruningSeenKey(TDirectoryName, Sample, NominalHist), {})
+	Shifts = tuple(UncertaintyGr.GetPointY(i) for i in range(0, UncertaintyGr.GetN()))
+	if Shifts in SeenGrs:
+		logging.info("Duplicate systematic:\t" + GrName + " of " + SeenGrs[Shifts])
+		SampleReport["Duplicates"][GrName] = SeenGrs[Shifts]
+		return Pruning["FlagOnly"]
+	SeenGrs[Shifts] = GrName
+	return True
+
+def PruningSeenKey(TDirectoryName, Sample, NominalHist):
+	return TDirectoryName + "/" + Sample + "/" + NominalHist.GetName()
+
+def SeedDuplicateSystematics(Pruning, OutputFile, TDirectoryName, Sample, NominalHists, SystematicNames):
+	SampleTDir = OutputFile.GetDirectory(TDirectoryName + "/" + Sample)
+	if SampleTDir == None:
+		return
+	for NominalHist in NominalHists:
+		SeenGrs = Pruning["Seen"].setdefault(PruningSeenKey(TDirectoryName, Sample, NominalHist), {})
+		# Same naming as GetUncertaintyGr, h_<...>_nominal becomes Gr_<...>_<syst>
+		GrBase = "Gr_" + NominalHist.GetName()[2:-len("_nominal")]
+		for SystematicName in SystematicNames:
+			Gr = SampleTDir.Get(GrBase + "_" + SystematicName)
+			if Gr == None:
+				Gr = SampleTDir.Get("Flavours/" + GrBase + "_" + SystematicName)
+			if Gr == None: continue
+			Shifts = tuple(Gr.GetPointY(i) for i in range(0, Gr.GetN()))
+			if Shifts not in SeenGrs:
+				SeenGrs[Shifts] = Gr.GetName()
+
+def DeleteObjects(Directory, Names):
+	for Name in Names:
+		if Directory.GetListOfKeys().FindObject(Name) != None:
+			logging.debug("Deleting pruned graph from output: " + Name)
+			Directory.Delete(Name + ";*")
+
+def WritePruningReport(Pruning):
+	if Pruning == None:
+		return
+	NNegligible = 0
+	NDuplicates = 0
+	for TDirectoryName, TDirReport in Pruning["Report"].items():
+		for Sample, SampleReport in TDirReport.items():
+			NNegligible = NNegligible + len(SampleReport["Negligible"])
+			NDuplicates = NDuplicates + len(SampleReport["Duplicates"])
+	if Pruning["FlagOnly"]:
+		logging.info("Flagged " + str(NNegligible) + " negligible and " + str(NDuplicates) + " duplicate systematic graphs")
+	else:
+		logging.info("Pruned " + str(NNegligible) + " negligible and " + str(NDuplicates) + " duplicate systematic graphs")
+	logging.info("Pruning report written to: " + Pruning["Path"])
+	WriteJsonAtomic(Pruning["Path"], {"AbsThreshold": Pruning["AbsThreshold"], "RelThreshold": Pruning["RelThreshold"], "FlagOnly": Pruning["FlagOnly"], "Report": Pruning["Report"]})
+
 def byteify(input):
   if isinstance(input, dict):
     return {byteify(key): byteify(value)
@@ -835,7 +1779,7 @@ def byteify(input):
 
 def tfile(path, mode='READ'):
 	if not os.path.exists(path):
-		if not mode=="UPDATE":
+		if not mode in ["UPDATE", "RECREATE"]:
 			raise RuntimeError("{} not found!".format(path))
 	tf = ROOT.TFile.Open(path, mode)
 	# if tf.IsZombie():
@@ -846,18 +1790,47 @@ def tfile(path, mode='READ'):
 
 def get_args():
 	args = argparse.ArgumentParser(description='')
+	# Arguments related to creating the _combination.root inputs from ntuples
+	args.add_argument('--CreateInputs', action="store_true", help="Fill the input histograms from flat ntuples with RDataFrame")
+	args.add_argument('--NtuplePath', type=str, default=os.getcwd()+"/ntuples/", help="Directory with one subdirectory of ntuples per sample")
+	args.add_argument('--Ntuples', type=str, default=os.getcwd()+"/Configs/ntuples.json", help="Branch expressions, binning, selections and systematics")
+	args.add_argument('--OverwriteInputs', action="store_true", help="Allow --CreateInputs to replace existing files under --InputPath")
+	args.add_argument('--Threads', type=int, default=0, help="Number of threads for the event loops, 0 uses all cores")
+
 	# Arguments related to the creating the input file for the plotter
 	args.add_argument('--CreateFile', action="store_true", help="If running for the first time, turn on.")
 	args.add_argument('--InputPath', type=str, default="/atlas/shatlas/FTAGCalibrations/code/AlvaroCode/TTbar-b-calib-final-selection-r21/Results/r21.2.130_combined/histograms/")
 	args.add_argument('--Plots', type=str, default=os.getcwd()+"/Configs/plots.json")
 	args.add_argument('--Samples', type=str, default=os.getcwd()+"/Configs/samples.json")
 	args.add_argument('--OutputFile', type=str, default=os.getcwd()+"/BTagHistSysts.root")
+	args.add_argument('--Catalog', type=str, default=os.getcwd()+"/InputCatalog.json", help="Index of the input files, refreshed when files change")
+	args.add_argument('--BuildCatalog', action="store_true", help="Only build or refresh the input catalog")
+	args.add_argument('--Resume', action="store_true", help="Skip units already completed in the journal of a previous --CreateFile run")
+	args.add_argument('--NoFlavours', action="store_true", help="Do not store the b, c and light components of each histogram")
+	args.add_argument('--Prune', action="store_true", help="Drop systematics that are negligible in every bin and count identical ones only once")
+	args.add_argument('--PruneAbs', type=float, default=0.0, help="A bin is negligible if its shift is at most this many events")
+	args.add_argument('--PruneRel', type=float, default=0.0, help="A bin is negligible if its relative shift is at most this")
+	args.add_argument('--PruneFlagOnly', action="store_true", help="Report negligible and duplicate systematics but still write them")
 	
 	# Arguments related to the plotter part of the code
 	args.add_argument('--PlotFile', action="store_true", help="Run after file created")
 	args.add_argument('--PlotFilename', type=str, default=os.getcwd()+"/BTagHistSysts.root", help="Name of the file to plot")
 	args.add_argument('--OutputDir', type=str, default=os.getcwd()+"/Plots/", help="Path for the plots")
 	args.add_argument('--NoBatch', action="store_true", help="Turn off batch mode so you see plots")
+	args.add_argument('--PlotFormat', type=str, default="pdf", help="File extension of the saved plots")
+	args.add_argument('--NoRenderCache', action="store_true", help="Redraw every plot even if its inputs are unchanged")
+	args.add_argument('--StackByFlavour', action="store_true", help="Stack the MC by jet flavour instead of by process")
+	args.add_argument('--ExportNumbers', action="store_true", help="Write yields, ratios and bands per channel without drawing any plots")
+	args.add_argument('--NumbersFormat', type=str, default="csv", choices=["csv", "json"], help="Format of the exported numbers")
+	args.add_argument('--Breakdown', action="store_true", help="Rank the systematics and groups per bin for every plot")
+	args.add_argument('--BreakdownTop', type=int, default=10, help="Number of systematics listed per bin in the breakdown")
+	args.add_argument('--BreakdownPlot', action="store_true", help="Also draw the per bin group breakdown")
+
+	# Arguments related to comparing two output files
+	args.add_argument('--Compare', type=str, nargs=2, metavar=("REFERENCE", "TARGET"), help="Compare two output files and exit non-zero if they differ")
+	args.add_argument('--AbsTol', type=float, default=1e-9, help="Absolute tolerance per bin for --Compare")
+	args.add_argument('--RelTol', type=float, default=1e-6, help="Relative tolerance per bin for --Compare")
+	args.add_argument('--CompareReport', type=str, default="", help="Optional json file for the --Compare results")
 	return args.parse_args()
 
 if __name__ == '__main__':